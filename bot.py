@@ -1,9 +1,19 @@
+import asyncio
+import calendar
+import json
 import logging
+import aiohttp
 import feedparser
 import os
+import pickle
+import random
+import re
+import sqlite3
 import time
+from lxml.html.clean import Cleaner
+from pybloom_live import ScalableBloomFilter
 from telegram import Update, BotCommand, Bot
-from telegram.ext import Application, CommandHandler, CallbackContext, JobQueue
+from telegram.ext import AIORateLimiter, Application, CommandHandler, CallbackContext, JobQueue
 from telegram.constants import ParseMode
 import html # For unescaping HTML entities if needed
 
@@ -15,8 +25,14 @@ TARGET_CHAT_ID = os.environ.get("CHAT_ID") # Your personal chat ID or a group/ch
 
 RSS_FEED_URL = "https://rss.app/feeds/OUYIM0VGlxqKueAS.xml"
 CHECK_INTERVAL_SECONDS = 300  # Check every 5 minutes
-SENT_ITEMS_FILE = "sent_rss_items.txt" # File to store IDs of sent items
+SENT_DB_FILE = "sent.db" # SQLite DB storing IDs of sent items
+BLOOM_FILE = "sent.bloom" # Pickled Bloom filter fronting the DB lookups
+FEED_STATE_FILE = "feed_state.json" # HTTP validators + timestamp watermark
+SENT_KEEP_LAST = 10_000 # IDs retained by the daily compaction job
+SENT_MAX_AGE_SECONDS = 30 * 86400 # IDs older than this are compacted away
 MAX_MESSAGE_LENGTH = 4096 # Telegram's message length limit
+MAX_CAPTION_LENGTH = 1024 # Telegram's photo caption limit
+MAX_DESC_BUDGET = MAX_MESSAGE_LENGTH - 64 # Room left for markup, newlines and "Read more"
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -25,112 +41,329 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # --- State Management (Sent Items) ---
-sent_item_ids = set()
-
-def load_sent_items():
-    """Loads sent item IDs from the file."""
-    global sent_item_ids
-    if os.path.exists(SENT_ITEMS_FILE):
-        with open(SENT_ITEMS_FILE, "r") as f:
-            sent_item_ids = {line.strip() for line in f if line.strip()}
-    logger.info(f"Loaded {len(sent_item_ids)} sent item IDs from {SENT_ITEMS_FILE}")
-
-def save_sent_item(item_id: str):
-    """Saves a new sent item ID to the file and set."""
-    sent_item_ids.add(item_id)
-    with open(SENT_ITEMS_FILE, "a") as f:
-        f.write(item_id + "\n")
+def init_sent_db() -> sqlite3.Connection:
+    """Opens (creating if needed) the SQLite store of sent item IDs."""
+    # check_same_thread off so writes can run in asyncio.to_thread workers;
+    # the connection is only ever used by one task at a time.
+    conn = sqlite3.connect(SENT_DB_FILE, check_same_thread=False)
+    # WAL avoids an fsync per write and keeps lookups crash-safe.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-2000")
+    conn.execute("CREATE TABLE IF NOT EXISTS sent (id TEXT PRIMARY KEY, ts INTEGER)")
+    # Migrate DBs created before the ts column existed.
+    cols = {row[1] for row in conn.execute("PRAGMA table_info(sent)")}
+    if "ts" not in cols:
+        conn.execute("ALTER TABLE sent ADD COLUMN ts INTEGER")
+    conn.commit()
+    logger.info("Opened sent-items DB at %s", SENT_DB_FILE)
+    return conn
+
+def load_bloom(conn: sqlite3.Connection) -> ScalableBloomFilter:
+    """Loads the persisted Bloom filter, rebuilding it from the DB if needed.
+
+    The filter must be a superset of the DB (a miss means "definitely new"),
+    so on a missing or unreadable pickle we rebuild from the sent table.
+    """
+    if os.path.exists(BLOOM_FILE):
+        try:
+            with open(BLOOM_FILE, "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            logger.warning("Could not load %s (%s), rebuilding from DB.", BLOOM_FILE, e)
+    bloom = ScalableBloomFilter(initial_capacity=10_000, error_rate=1e-4)
+    for (item_id,) in conn.execute("SELECT id FROM sent"):
+        bloom.add(item_id)
+    return bloom
+
+def save_bloom(bloom: ScalableBloomFilter):
+    """Persists the Bloom filter so restarts keep the fast-path warm."""
+    with open(BLOOM_FILE, "wb") as f:
+        pickle.dump(bloom, f)
+
+def load_feed_state() -> dict:
+    """Loads the persisted ETag/Last-Modified validators and watermark."""
+    if os.path.exists(FEED_STATE_FILE):
+        try:
+            with open(FEED_STATE_FILE, "r") as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning("Could not load %s (%s), starting fresh.", FEED_STATE_FILE, e)
+    return {}
+
+def save_feed_state(state: dict):
+    """Atomically persists feed state so restarts reuse 304 responses."""
+    tmp = FEED_STATE_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, FEED_STATE_FILE)
+
+def is_item_sent(conn: sqlite3.Connection, item_id: str) -> bool:
+    """Checks whether an item ID has already been sent."""
+    return conn.execute(
+        "SELECT 1 FROM sent WHERE id=? LIMIT 1", (item_id,)
+    ).fetchone() is not None
+
+def mark_items_sent(conn: sqlite3.Connection, item_ids: list):
+    """Records a batch of sent item IDs in a single transaction."""
+    now = int(time.time())
+    conn.executemany(
+        "INSERT OR IGNORE INTO sent(id, ts) VALUES (?, ?)",
+        ((i, now) for i in item_ids),
+    )
+    conn.commit()
+
+async def compact_sent_items(context: CallbackContext):
+    """Daily job: trims the sent table to the newest IDs and reclaims space."""
+    sent_db = context.bot_data['sent_db']
+
+    def _compact() -> int:
+        # Expire by age first (rows migrated from before the ts column have
+        # NULL ts and are left to the size cap), then cap the table size.
+        cutoff = int(time.time()) - SENT_MAX_AGE_SECONDS
+        deleted = sent_db.execute(
+            "DELETE FROM sent WHERE ts < ?", (cutoff,)
+        ).rowcount
+        deleted += sent_db.execute(
+            "DELETE FROM sent WHERE rowid NOT IN "
+            "(SELECT rowid FROM sent ORDER BY rowid DESC LIMIT ?)",
+            (SENT_KEEP_LAST,),
+        ).rowcount
+        sent_db.commit()
+        sent_db.execute("VACUUM")
+        return deleted
+
+    deleted = await asyncio.to_thread(_compact)
+    if deleted > 0:
+        logger.info("Compacted sent DB: dropped %d old item IDs.", deleted)
 
 # --- RSS Fetching and Sending Logic ---
+# Keep only the inline tags Telegram's HTML parse mode accepts; compiled once
+# at module load.
+CLEANER = Cleaner(
+    allow_tags={"b", "strong", "i", "em", "a", "code", "pre"},
+    remove_unknown_tags=False,
+    safe_attrs={"href"},
+)
+
+def _clean_description(raw: str) -> str:
+    """Strips HTML Telegram won't render from a feed summary (CPU-bound)."""
+    cleaned = CLEANER.clean_html(f"<div>{raw}</div>")
+    # clean_html keeps the wrapper <div> we added; drop it again.
+    return cleaned[len("<div>"):-len("</div>")].strip()
+
+def _entry_image(entry):
+    """URL of a usable thumbnail or image enclosure for an entry, or None."""
+    for thumb in entry.get("media_thumbnail") or []:
+        if thumb.get("url"):
+            return thumb["url"]
+    for enclosure in entry.get("enclosures") or []:
+        if enclosure.get("type", "").startswith("image/") and enclosure.get("href"):
+            return enclosure["href"]
+    return None
+
+def _entry_ts(entry) -> float:
+    """Unix timestamp of an entry's publication, 0.0 when absent."""
+    parsed = entry.get("published_parsed")
+    return calendar.timegm(parsed) if parsed else 0.0
+
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+def _cache_max_age(cache_control) -> int:
+    """Seconds from a Cache-Control max-age directive, 0 when absent."""
+    match = _MAX_AGE_RE.search(cache_control or "")
+    return int(match.group(1)) if match else 0
+
+
 async def check_rss_feed(context: CallbackContext):
     """Fetches the RSS feed, checks for new items, and sends them."""
-    if not context.bot_data.get('chat_id_confirmed', False) and not TARGET_CHAT_ID:
-        logger.warning("TARGET_CHAT_ID not set and no /start command received yet. Skipping RSS check.")
-        return
+    # ±10% jitter on the next poll keeps multiple deployments against the
+    # same feed from ticking in lockstep; a server Cache-Control max-age can
+    # push it further out.
+    next_delay = CHECK_INTERVAL_SECONDS * random.uniform(0.9, 1.1)
+    try:
+        if not context.bot_data.get('chat_id_confirmed', False) and not TARGET_CHAT_ID:
+            logger.warning("TARGET_CHAT_ID not set and no /start command received yet. Skipping RSS check.")
+            return
 
-    current_target_chat_id = TARGET_CHAT_ID or context.bot_data.get('user_chat_id')
-    if not current_target_chat_id:
-        logger.error("No target chat ID available to send messages.")
-        return
+        current_target_chat_id = TARGET_CHAT_ID or context.bot_data.get('user_chat_id')
+        if not current_target_chat_id:
+            logger.error("No target chat ID available to send messages.")
+            return
 
-    logger.info(f"Checking RSS feed: {RSS_FEED_URL}")
-    try:
-        feed = feedparser.parse(RSS_FEED_URL)
+        sent_db = context.bot_data['sent_db']
+        bloom = context.bot_data['bloom']
+        # Small set of IDs sent this session but not yet committed to the DB;
+        # keeps the batched commit from letting duplicates through mid-tick.
+        pending = context.bot_data.setdefault('pending_sent', set())
+
+        logger.info("Checking RSS feed: %s", RSS_FEED_URL)
+        # Fetch over the shared keepalive session (gzip negotiated by
+        # default), with conditional-GET headers so an unchanged feed comes
+        # back as a bodyless 304.
+        http = context.bot_data['http']
+        req_headers = {}
+        if context.bot_data.get('feed_etag'):
+            req_headers["If-None-Match"] = context.bot_data['feed_etag']
+        if context.bot_data.get('feed_modified'):
+            req_headers["If-Modified-Since"] = context.bot_data['feed_modified']
+        async with http.get(RSS_FEED_URL, headers=req_headers) as response:
+            # When the server declares a cache lifetime, polling sooner than
+            # that is guaranteed wasted work.
+            next_delay = max(next_delay, _cache_max_age(response.headers.get("Cache-Control")))
+            if response.status == 304:
+                logger.info("Feed not modified since last check (304). Nothing to do.")
+                return
+            response.raise_for_status()
+            etag = response.headers.get("ETag")
+            modified = response.headers.get("Last-Modified")
+            raw = await response.read()
+
+        # The XML parse is CPU-bound; keep it off the event loop.
+        feed = await asyncio.to_thread(feedparser.parse, raw)
         if feed.bozo:
-            logger.error(f"Error parsing RSS feed: {feed.bozo_exception}")
+            logger.error("Error parsing RSS feed: %s", feed.bozo_exception)
             # Optionally send an error message to the admin/chat
             # await context.bot.send_message(chat_id=current_target_chat_id, text=f"⚠️ Error parsing RSS feed: {RSS_FEED_URL}")
             return
 
-        new_items_found = 0
-        for entry in reversed(feed.entries): # Process oldest new items first
+        # Walk timestamped entries newest-first and stop at the first one
+        # strictly below the highest timestamp seen so far, so a tick costs
+        # O(new entries) instead of O(total entries). Strict '<' because RSS
+        # timestamps have one-second resolution: an entry sharing the
+        # watermark second can first appear a tick later, and the Bloom/DB
+        # check absorbs the re-examined boundary. Entries without a
+        # timestamp can't be ordered against the watermark, so they are
+        # partitioned out and always go to the Bloom/DB check.
+        last_seen_ts = context.bot_data.get('last_seen_ts', 0.0)
+        newest_ts = last_seen_ts
+        new_entries = [] # (ts, entry) pairs to examine this tick
+        timed = []
+        for entry in feed.entries:
+            ts = _entry_ts(entry)
+            if ts > 0.0:
+                timed.append((ts, entry))
+            else:
+                new_entries.append((0.0, entry))
+        timed.sort(key=lambda pair: pair[0], reverse=True)
+        for ts, entry in timed:
+            if ts < last_seen_ts:
+                break # Everything from here on was seen on a previous tick
+            new_entries.append((ts, entry))
+            newest_ts = max(newest_ts, ts)
+
+        newly_sent = [] # IDs to persist in one transaction after the loop
+        send_failed = False
+        oldest_failed_ts = None # Bounds the watermark so failed sends retry
+        for ts, entry in reversed(new_entries): # Process oldest new items first
             # Determine a unique identifier for the item
-            item_id = entry.get("id", entry.get("link")) # 'id' is preferred, fallback to 'link'
+            item_id = entry.get("id") or entry.get("link") # 'id' is preferred, fallback to 'link'
             if not item_id:
-                logger.warning(f"Entry without id or link: {entry.get('title', 'N/A')}")
+                logger.warning("Entry without id or link: %s", entry.get('title', 'N/A'))
                 continue
 
-            if item_id not in sent_item_ids:
-                logger.info(f"New item found: {entry.title}")
+            # Bloom miss means definitely new; on a hit, confirm against the
+            # pending set and the DB to rule out false positives.
+            if not (item_id in bloom and (item_id in pending or is_item_sent(sent_db, item_id))):
+                logger.info("New item found: %s", entry.title)
 
-                title = entry.get("title", "No Title")
-                link = entry.get("link", "")
-                description = entry.get("summary", entry.get("description", "")) # summary often preferred
+                _get = entry.get # Bind once; saves a method lookup per field
+                title = _get("title") or "No Title"
+                link = _get("link") or ""
+                description = _get("summary") or _get("description") or "" # summary often preferred
 
-                # Clean up description (optional, depends on feed quality)
-                # description = html.unescape(description) # Basic unescaping
-                # For more complex HTML, consider BeautifulSoup to strip tags or reformat
+                if description:
+                    # The cleaner is C-backed but still costs CPU per entry;
+                    # keep it off the event loop.
+                    description = await asyncio.to_thread(_clean_description, description)
+
+                # Escape once per entry; both the main message and the "too
+                # long" fallback reuse these.
+                esc_title = html.escape(title)
+                esc_link = html.escape(link)
 
-                message = f"<b>{html.escape(title)}</b>\n\n"
                 if description:
                     # Truncate description to avoid exceeding message limits
-                    # Max length for caption is 1024, for message 4096.
-                    # Let's keep it reasonably short.
-                    max_desc_len = MAX_MESSAGE_LENGTH - len(message) - len(link) - 50 # 50 for safety and formatting
-                    if len(description) > max_desc_len:
-                        description = description[:max_desc_len] + "..."
-                    message += f"{description}\n\n" # Telegram will parse common HTML tags like <b>, <i>, <a>
-
-                if link:
-                    message += f'<a href="{html.escape(link)}">Read more</a>'
+                    allowed = MAX_DESC_BUDGET - len(esc_title) - len(esc_link)
+                    if len(description) > allowed:
+                        description = description[:allowed] + "..."
+                    desc_part = f"{description}\n\n" # Telegram will parse common HTML tags like <b>, <i>, <a>
                 else:
-                    message += "No link available."
-
-
+                    desc_part = ""
+                link_part = f'<a href="{esc_link}">Read more</a>' if link else "No link available."
+                message = f"<b>{esc_title}</b>\n\n{desc_part}{link_part}"
+                if len(message) > MAX_MESSAGE_LENGTH:
+                    # Pathological title/link blew past the budget even after
+                    # description truncation; send title + link only.
+                    message = f"<b>{esc_title}</b>\n\n{link_part}"
+
+                photo_url = _entry_image(entry)
                 try:
-                    await context.bot.send_message(
-                        chat_id=current_target_chat_id,
-                        text=message,
-                        parse_mode=ParseMode.HTML,
-                        disable_web_page_preview=False # Set to True if you don't want link previews
-                    )
-                    save_sent_item(item_id)
-                    new_items_found += 1
-                    await asyncio.sleep(1) # Small delay to avoid hitting rate limits if many new items
+                    # Pacing is handled by the AIORateLimiter configured on
+                    # the Application; bursts are queued, not rejected.
+                    if photo_url and len(message) <= MAX_CAPTION_LENGTH:
+                        # The feed already carries the image: one RPC, no
+                        # server-side preview fetch on Telegram's end.
+                        await context.bot.send_photo(
+                            chat_id=current_target_chat_id,
+                            photo=photo_url,
+                            caption=message,
+                            parse_mode=ParseMode.HTML,
+                        )
+                    else:
+                        await context.bot.send_message(
+                            chat_id=current_target_chat_id,
+                            text=message,
+                            parse_mode=ParseMode.HTML,
+                            disable_web_page_preview=True # Skip Telegram's preview fetch
+                        )
+                    bloom.add(item_id)
+                    pending.add(item_id)
+                    newly_sent.append(item_id)
                 except Exception as e:
-                    logger.error(f"Error sending Telegram message for '{title}': {e}")
-                    # If message is too long, try sending a shorter version
-                    if "message is too long" in str(e).lower():
-                        try:
-                            short_message = f"<b>{html.escape(title)}</b>\n\n<a href='{html.escape(link)}'>Read more</a>"
-                            await context.bot.send_message(
-                                chat_id=current_target_chat_id,
-                                text=short_message,
-                                parse_mode=ParseMode.HTML
-                            )
-                            save_sent_item(item_id)
-                            new_items_found += 1
-                        except Exception as e_short:
-                            logger.error(f"Error sending SHORTER Telegram message for '{title}': {e_short}")
-                    # Potentially add more specific error handling here
-
-        if new_items_found > 0:
-            logger.info(f"Sent {new_items_found} new items to chat {current_target_chat_id}.")
+                    logger.error("Error sending Telegram message for '%s': %s: %s", title, type(e).__name__, e)
+                    send_failed = True
+                    if ts > 0.0 and (oldest_failed_ts is None or ts < oldest_failed_ts):
+                        oldest_failed_ts = ts
+
+        if oldest_failed_ts is not None:
+            # Don't advance the watermark past an entry whose send failed:
+            # with the strict '<' break it is re-examined and retried next
+            # tick, and the Bloom/DB check skips whatever else gets
+            # re-examined alongside it.
+            newest_ts = min(newest_ts, oldest_failed_ts)
+        if send_failed:
+            # Drop the fresh validators too: an unchanged feed would answer
+            # the next conditional request with a 304 and the check would
+            # return before any entry is examined, deferring the retry until
+            # the feed body actually changes.
+            etag = modified = None
+        # Stash the validators for the next tick's conditional request only
+        # once the body parsed cleanly and every send landed, so broken
+        # feeds and failed sends both get a refetch.
+        context.bot_data['feed_etag'] = etag
+        context.bot_data['feed_modified'] = modified
+        context.bot_data['last_seen_ts'] = newest_ts
+        await asyncio.to_thread(save_feed_state, {
+            'etag': etag,
+            'modified': modified,
+            'last_seen_ts': newest_ts,
+        })
+        if newly_sent:
+            # One transaction per feed check; run the disk writes in a worker
+            # thread so a slow disk doesn't stall the event loop.
+            await asyncio.to_thread(mark_items_sent, sent_db, newly_sent)
+            pending.difference_update(newly_sent) # Committed; the DB covers them now
+            await asyncio.to_thread(save_bloom, bloom) # Keep the filter in sync with the committed DB
+            logger.info("Sent %d new items to chat %s.", len(newly_sent), current_target_chat_id)
         else:
             logger.info("No new items found in this check.")
 
     except Exception as e:
-        logger.error(f"An error occurred during RSS check: {e}")
+        logger.error("An error occurred during RSS check: %s", e)
+    finally:
+        context.job_queue.run_once(check_rss_feed, when=next_delay)
         # await context.bot.send_message(chat_id=current_target_chat_id, text=f"⚠️ An error occurred while checking RSS: {e}")
 
 
@@ -143,9 +376,9 @@ async def start(update: Update, context: CallbackContext):
 
     welcome_message = (
         "👋 Hello! I am your Updated Biharan Feed Bot.\n\n"
-        "I will periodically check the RSS feed and send new items.\n\"
+        "I will periodically check the RSS feed and send new items.\n"
     )
-    if TARGET_CHAT_ID:T_CHAT_ID:
+    if TARGET_CHAT_ID:
          welcome_message = (
             f"👋 Hello! I am your RSS Feed Bot.\n\n"
             f"I am configured to send updates to chat ID: `{TARGET_CHAT_ID}`.\n"
@@ -153,7 +386,7 @@ async def start(update: Update, context: CallbackContext):
         )
 
     await update.message.reply_text(welcome_message, parse_mode=ParseMode.MARKDOWN_V2)
-    logger.info(f"/start command received from chat_id: {user_chat_id}. Bot will now post to {TARGET_CHAT_ID or user_chat_id}")
+    logger.info("/start command received from chat_id: %s. Bot will now post to %s", user_chat_id, TARGET_CHAT_ID or user_chat_id)
 
     # Manually trigger the first check if desired, or wait for the job
     # await check_rss_feed(context)
@@ -166,6 +399,19 @@ async def set_commands(application: Application):
     ]
     await application.bot.set_my_commands(commands)
 
+async def startup(application: Application):
+    """Creates the shared HTTP session and registers the bot commands."""
+    application.bot_data['http'] = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=30),
+        headers={"Accept-Encoding": "gzip, deflate"},
+    )
+    await set_commands(application)
+
+async def shutdown(application: Application):
+    """Closes the HTTP session and persists the Bloom filter on shutdown."""
+    await application.bot_data['http'].close()
+    save_bloom(application.bot_data['bloom'])
+
 # --- Main Bot Setup ---
 def main() -> None:
     """Starts the bot."""
@@ -176,9 +422,28 @@ def main() -> None:
         logger.warning("CHAT_ID environment variable not set. "
                        "The bot will only send messages to the chat where /start is first used.")
 
-    load_sent_items()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        # Respect Telegram's 30 msg/s global and 20 msg/min per-group limits;
+        # retry_after from the server is honored automatically.
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=30,
+            overall_time_period=1,
+            group_max_rate=20,
+            group_time_period=60,
+            max_retries=3,
+        ))
+        .build()
+    )
+
+    application.bot_data['sent_db'] = init_sent_db()
+    application.bot_data['bloom'] = load_bloom(application.bot_data['sent_db'])
 
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    feed_state = load_feed_state()
+    application.bot_data['feed_etag'] = feed_state.get('etag')
+    application.bot_data['feed_modified'] = feed_state.get('modified')
+    application.bot_data['last_seen_ts'] = feed_state.get('last_seen_ts', 0.0)
 
     # Store chat_id_confirmed flag in bot_data, initially False
     application.bot_data['chat_id_confirmed'] = False
@@ -191,16 +456,17 @@ def main() -> None:
 
     # Setup job queue for periodic RSS checks
     job_queue = application.job_queue
-    # Run the first check shortly after start, then repeat
-    job_queue.run_repeating(check_rss_feed, interval=CHECK_INTERVAL_SECONDS, first=10) # First check after 10s
+    # First check shortly after start; each check reschedules the next one
+    # itself with jitter.
+    job_queue.run_once(check_rss_feed, when=10)
+    job_queue.run_repeating(compact_sent_items, interval=86400, first=3600) # Daily DB compaction
 
     # Set bot commands (optional, but good practice)
-    application.post_init = set_commands
+    application.post_init = startup
+    application.post_shutdown = shutdown
 
     logger.info("Bot starting...")
     application.run_polling()
 
 if __name__ == "__main__":
-    # For asyncio related parts when running directly
-    import asyncio
-    asyncio.run(main())
+    main()